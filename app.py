@@ -4,119 +4,210 @@ import openpyxl
 from io import BytesIO
 from openpyxl.utils import get_column_letter
 from openpyxl.styles import Border
-from openpyxl.cell.cell import MergedCell
+from openpyxl.cell.cell import Cell, MergedCell
+from openpyxl.styles.cell_style import StyleArray
 from copy import copy
 from datetime import date
+from dataclasses import dataclass
 from dateutil.relativedelta import relativedelta
 import re
 from datetime import datetime
 from openpyxl.utils import column_index_from_string
 import gc
+import logging
+import time
+import hashlib
+import tempfile
+import weakref
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from itertools import takewhile
 
 # =========================================================
 # 1. FUNÇÕES AUXILIARES E REGRAS DE NEGÓCIO (Intactas)
 # =========================================================
 
+logger = logging.getLogger(__name__)
+
+# Por workbook: ids do estilo de origem -> ids que copiar_estilo produz
+_CACHE_ESTILOS = weakref.WeakKeyDictionary()
+
 def copiar_estilo(celula_origem, celula_destino):
     if celula_origem.has_style:
-        celula_destino.font = copy(celula_origem.font)
+        wb = celula_destino.parent.parent
+        cache = _CACHE_ESTILOS.setdefault(wb, {}) if celula_origem.parent.parent is wb else None
+        chave = tuple(celula_origem._style)
+        if cache is not None and chave in cache:
+            if celula_destino._style is None: celula_destino._style = StyleArray()
+            estilo = celula_destino._style
+            estilo.fontId, estilo.borderId, estilo.fillId, estilo.numFmtId, estilo.alignmentId = cache[chave]
+            return
+        if cache is not None:
+            # Mesmo workbook: aponta para os mesmos índices de estilo da origem
+            if celula_destino._style is None: celula_destino._style = StyleArray()
+            estilo, origem = celula_destino._style, celula_origem._style
+            estilo.fontId, estilo.fillId, estilo.numFmtId, estilo.alignmentId = origem.fontId, origem.fillId, origem.numFmtId, origem.alignmentId
+        else:
+            celula_destino.font = copy(celula_origem.font)
+            celula_destino.fill = copy(celula_origem.fill)
+            celula_destino.number_format = celula_origem.number_format
+            celula_destino.alignment = copy(celula_origem.alignment)
         b_origem = celula_origem.border
         if b_origem:
             celula_destino.border = Border(
-                left=copy(b_origem.left), right=copy(b_origem.right),
-                top=copy(b_origem.top), bottom=copy(b_origem.bottom),
-                diagonal=copy(b_origem.diagonal), diagonal_direction=b_origem.diagonal_direction,
+                left=b_origem.left, right=b_origem.right, top=b_origem.top, bottom=b_origem.bottom,
+                diagonal=b_origem.diagonal, diagonal_direction=b_origem.diagonal_direction,
                 outline=b_origem.outline, vertical=b_origem.vertical, horizontal=b_origem.horizontal
             )
-        celula_destino.fill = copy(celula_origem.fill)
-        celula_destino.number_format = celula_origem.number_format
-        celula_destino.alignment = copy(celula_origem.alignment)
+        if cache is not None:
+            estilo = celula_destino._style
+            cache[chave] = (estilo.fontId, estilo.borderId, estilo.fillId, estilo.numFmtId, estilo.alignmentId)
+
+# Por aba: linha -> {valor do cabeçalho: primeira coluna em que aparece}
+_CACHE_CABECALHOS = weakref.WeakKeyDictionary()
+
+def indice_cabecalho(ws, linha=1):
+    por_linha = _CACHE_CABECALHOS.setdefault(ws, {})
+    if linha not in por_linha:
+        indice = {}
+        for col, valor in enumerate(next(ws.iter_rows(min_row=linha, max_row=linha, values_only=True), ()), start=1):
+            if valor is not None: indice.setdefault(valor, col)
+        por_linha[linha] = indice
+    return por_linha[linha]
 
 def encontrar_coluna_por_header(ws, nome_header):
-    for col in range(1, ws.max_column + 1):
-        if ws.cell(row=1, column=col).value == nome_header:
-            return col
-    return None
-
-def validar_abas_necessarias(parceiro_wb, base_wb):
-    abas_parceiro_necessarias = ['Parcelas Pagas', 'Produção']
-    abas_base_necessarias = ['BASE', 'INADIMPLENTES', 'JAN.26'] 
-    for aba in abas_parceiro_necessarias:
-        if aba not in parceiro_wb.sheetnames: return False, f"Aba '{aba}' não encontrada no arquivo PARCEIRO"
-    for aba in abas_base_necessarias:
-        if aba not in base_wb.sheetnames: return False, f"Aba '{aba}' não encontrada no arquivo BASE"
+    return indice_cabecalho(ws).get(nome_header)
+
+ABAS_PARCEIRO_NECESSARIAS = ('Parcelas Pagas', 'Produção')
+ABAS_BASE_NECESSARIAS = ('BASE', 'INADIMPLENTES', 'JAN.26')
+
+def validar_abas_necessarias(wb, abas_necessarias, nome_arquivo):
+    abas = set(wb.sheetnames)
+    for aba in abas_necessarias:
+        if aba not in abas: return False, f"Aba '{aba}' não encontrada no arquivo {nome_arquivo}"
     return True, "Todas as abas necessárias estão presentes"
 
-def encontrar_ultima_linha(ws):
+def encontrar_ultima_linha(ws, coluna_chave=1):
+    # Só a coluna_chave decide se a linha está preenchida; None considera qualquer coluna
+    primeira_col, ultima_col = (coluna_chave, coluna_chave) if coluna_chave else (1, None)
+    # Recua a partir do max_row pelas linhas em branco, lendo _cells direto
+    celulas = ws._cells
+    colunas = range(primeira_col, (ultima_col or ws.max_column) + 1)
     for row in range(ws.max_row, 0, -1):
-        if any(ws.cell(row=row, column=col).value is not None for col in range(1, ws.max_column + 1)):
+        if any(getattr(celulas.get((row, col)), 'value', None) is not None for col in colunas):
             return row
     return 0
 
-def calcular_mes_anterior(mes_str):
-    meses_eng = {'JAN': 1, 'FEV': 2, 'MAR': 3, 'ABR': 4, 'MAI': 5, 'JUN': 6, 'JUL': 7, 'AGO': 8, 'SET': 9, 'OUT': 10, 'NOV': 11, 'DEZ': 12}
-    meses_pt = {1: 'jan', 2: 'fev', 3: 'mar', 4: 'abr', 5: 'mai', 6: 'jun', 7: 'jul', 8: 'ago', 9: 'set', 10: 'out', 11: 'nov', 12: 'dez'}
-    partes = mes_str.upper().strip().split('.')
-    mes_num = meses_eng[partes[0]]
-    ano = 2000 + int(partes[1])
-    d = date(ano, mes_num, 1)
+MESES_NUM = {'JAN': 1, 'FEV': 2, 'MAR': 3, 'ABR': 4, 'MAI': 5, 'JUN': 6, 'JUL': 7, 'AGO': 8, 'SET': 9, 'OUT': 10, 'NOV': 11, 'DEZ': 12}
+MESES_PT = {1: 'jan', 2: 'fev', 3: 'mar', 4: 'abr', 5: 'mai', 6: 'jun', 7: 'jul', 8: 'ago', 9: 'set', 10: 'out', 11: 'nov', 12: 'dez'}
+
+@dataclass(frozen=True)
+class ContextoMes:
+    nome: str        # como digitado no formulário (ex.: FEV.26); também é o nome da aba do mês
+    mes_num: int
+    ano: int
+    faturado: str    # ex.: fev/26, como aparece na linha 2 do RESUMO
+    anterior: str    # mês de referência, ex.: jan/26
+    data_ref: date   # primeiro dia do mês alvo
+
+def calcular_mes_anterior(mes_num, ano):
     d_ant = date(ano - 1, 12, 1) if mes_num == 1 else date(ano, mes_num - 1, 1)
-    return f"{meses_pt[d_ant.month]}/{str(d_ant.year)[-2:]}"
+    return f"{MESES_PT[d_ant.month]}/{str(d_ant.year)[-2:]}"
+
+def interpretar_mes(target_month):
+    partes = target_month.upper().strip().split('.')
+    mes_num, ano = MESES_NUM[partes[0]], 2000 + int(partes[1])
+    return ContextoMes(target_month, mes_num, ano, target_month.replace('.', '/').lower(), calcular_mes_anterior(mes_num, ano), date(ano, mes_num, 1))
+
+# Fórmulas do RESUMO por linha, preenchidas com str.format na hora de gravar cada coluna
+FORMULAS_RESUMO_MES = (
+    (4, "=SUMIF(BASE!$K:$K,RESUMO!{letra}3,BASE!$D:$D)"),
+    (5, "=COUNTIF(BASE!$K:$K,RESUMO!{letra}3)"),
+    (6, "={letra}4*3%"),
+)
+FORMULAS_RESUMO_CICLO = (
+    (10, '=COUNTIFS(BASE!$H:$H,">={data_ini}",BASE!$H:$H,"<={data_fim}")'),
+    (11, '=SUMIFS(BASE!$D:$D,BASE!$H:$H,">={data_ini}",BASE!$H:$H,"<={data_fim}")'),
+    (12, "=SUM('{aba}'!L:L)"),
+    (13, "=COUNTA('{aba}'!O:O)-1"),
+    (14, '=COUNTIFS(\'{aba}\'!R:R,">={data_ini}",\'{aba}\'!R:R,"<={data_fim}")'),
+    (15, "={letra}13-{letra}14"),
+    (17, "={letra}14-{letra}10"),
+)
+FORMULAS_RESUMO_BLOCO_FINAL = (
+    (21, "={letra}6"),
+    (22, "={letra}12"),
+    (23, "=SUM({letra}21:{letra}22)"),
+)
+
+# Gravação direta em ws._cells; None em célula inexistente não cria nada
+def escrever_coluna(ws, col, valores):
+    celulas = ws._cells
+    for row, valor in valores.items():
+        celula = celulas.get((row, col))
+        if celula is None:
+            if valor is None: continue
+            celula = celulas[(row, col)] = Cell(ws, row=row, column=col)
+        celula.value = valor
+
+def escrever_linha(ws, row, valores):
+    celulas = ws._cells
+    for col, valor in valores.items():
+        celula = celulas.get((row, col))
+        if celula is None:
+            if valor is None: continue
+            celula = celulas[(row, col)] = Cell(ws, row=row, column=col)
+        celula.value = valor
+
+def estilos_da_linha(ws, row, colunas):
+    # {coluna: StyleArray} das células com estilo na linha-molde
+    celulas = ws._cells
+    return {col: celulas[(row, col)]._style for col in colunas if (row, col) in celulas and celulas[(row, col)].has_style}
+
+def encontrar_coluna_molde(ws, row, antes_de):
+    # Coluna preenchida mais próxima à esquerda de antes_de na linha (0 se não houver)
+    celulas = ws._cells
+    return next((col for col in range(antes_de - 1, 0, -1) if getattr(celulas.get((row, col)), 'value', None) is not None), 0)
 
 def encontrar_ultima_coluna_resumo(ws):
-    ultima = 1
-    for col in range(1, ws.max_column + 1):
-        if ws.cell(row=2, column=col).value is not None: ultima = col
-    return ultima
+    # Última coluna preenchida da linha 2
+    valores = next(ws.iter_rows(min_row=2, max_row=2, values_only=True), ())
+    return next((col for col in range(len(valores), 0, -1) if valores[col - 1] is not None), 1)
 
-def atualizar_resumo_mes_faturamento(base_wb, target_month):
+def atualizar_resumo_mes_faturamento(base_wb, mes, ultima_col=None):
     ws_resumo = base_wb['RESUMO']
-    ultima_col = encontrar_ultima_coluna_resumo(ws_resumo)
+    if ultima_col is None: ultima_col = encontrar_ultima_coluna_resumo(ws_resumo)
     nova_coluna = ultima_col + 1
     
-    linha2_vazia = ws_resumo.cell(row=2, column=nova_coluna).value is None
-    linha9_vazia = ws_resumo.cell(row=9, column=nova_coluna).value is None
-    linha9_valor = ws_resumo.cell(row=9, column=nova_coluna).value
-    eh_header_regras = linha9_valor and 'REGRA' in str(linha9_valor).upper()
-    
-    if not (linha2_vazia and linha9_vazia and not eh_header_regras): ws_resumo.insert_cols(nova_coluna)
+    # Abre espaço quando a coluna já está ocupada pelo bloco de REGRAS na linha 9
+    if ws_resumo.cell(row=9, column=nova_coluna).value is not None:
+        ws_resumo.insert_cols(nova_coluna)
+        _CACHE_CABECALHOS.pop(ws_resumo, None)
     
     letra = get_column_letter(nova_coluna)
-    mes_faturado = target_month.replace('.', '/').lower()
-    mes_ref = calcular_mes_anterior(target_month)
-
-    ws_resumo.cell(row=2, column=nova_coluna, value=mes_faturado)
-    ws_resumo.cell(row=3, column=nova_coluna, value=mes_ref)
-    ws_resumo.cell(row=4, column=nova_coluna, value=f"=SUMIF(BASE!$K:$K,RESUMO!{letra}3,BASE!$D:$D)")
-    ws_resumo.cell(row=5, column=nova_coluna, value=f"=COUNTIF(BASE!$K:$K,RESUMO!{letra}3)")
-    ws_resumo.cell(row=6, column=nova_coluna, value=f"={letra}4*3%")
-
-    col_molde = nova_coluna - 1
-    while col_molde >= 1:
-        if ws_resumo.cell(row=4, column=col_molde).value is not None: break
-        col_molde -= 1
-    
-    if col_molde >= 1:
+
+    valores = {2: mes.faturado, 3: mes.anterior}
+    valores.update((row, formula.format(letra=letra)) for row, formula in FORMULAS_RESUMO_MES)
+    escrever_coluna(ws_resumo, nova_coluna, valores)
+
+    col_molde = encontrar_coluna_molde(ws_resumo, 4, nova_coluna)
+    if col_molde:
         for r in range(2, 7): copiar_estilo(ws_resumo.cell(row=r, column=col_molde), ws_resumo.cell(row=r, column=nova_coluna))
     return nova_coluna
 
-def atualizar_resumo_ciclo_pmt(base_wb, target_month):
+def atualizar_resumo_ciclo_pmt(base_wb, mes, col_idx=None):
     ws_resumo = base_wb['RESUMO']
-    mes_faturado = target_month.replace('.', '/').lower()
+    mes_faturado = mes.faturado
     
-    col_idx = None
-    for col in range(1, ws_resumo.max_column + 1):
-        val = ws_resumo.cell(row=2, column=col).value
-        if val and str(val).strip().lower() == mes_faturado:
-            col_idx = col
-            break
+    if col_idx is None:
+        # Coluna do mês faturado na linha 2
+        linha_2 = next(ws_resumo.iter_rows(min_row=2, max_row=2, values_only=True), ())
+        col_idx = next((col for col, val in enumerate(linha_2, start=1) if val and str(val).strip().lower() == mes_faturado), None)
             
     if not col_idx: raise ValueError(f"Coluna com '{mes_faturado}' não encontrada na aba RESUMO")
     
-    meses_eng = {'JAN': 1, 'FEV': 2, 'MAR': 3, 'ABR': 4, 'MAI': 5, 'JUN': 6, 'JUL': 7, 'AGO': 8, 'SET': 9, 'OUT': 10, 'NOV': 11, 'DEZ': 12}
-    partes = target_month.upper().strip().split('.')
-    data_ref = date(2000 + int(partes[1]), meses_eng[partes[0]], 1)
-    data_ref_menos_4 = data_ref - relativedelta(months=4)
+    data_ref_menos_4 = mes.data_ref - relativedelta(months=4)
     
     data_ini = date(data_ref_menos_4.year, data_ref_menos_4.month, 23)
     data_fim_mes = data_ref_menos_4 + relativedelta(months=1)
@@ -127,30 +218,31 @@ def atualizar_resumo_ciclo_pmt(base_wb, target_month):
     header_str = f"{data_ini.strftime('%d/%m')} a {data_fim.strftime('%d/%m')} - {data_ini.year}"
     letra = get_column_letter(col_idx)
     
-    ws_resumo.cell(row=9, column=col_idx, value=header_str)
-    ws_resumo.cell(row=10, column=col_idx, value=f'=COUNTIFS(BASE!$H:$H,">={data_ini_str}",BASE!$H:$H,"<={data_fim_str}")')
-    ws_resumo.cell(row=11, column=col_idx, value=f'=SUMIFS(BASE!$D:$D,BASE!$H:$H,">={data_ini_str}",BASE!$H:$H,"<={data_fim_str}")')
-    ws_resumo.cell(row=12, column=col_idx, value=f"=SUM('{target_month}'!L:L)")
-    ws_resumo.cell(row=13, column=col_idx, value=f"=COUNTA('{target_month}'!O:O)-1")
-    ws_resumo.cell(row=14, column=col_idx, value=f'=COUNTIFS(\'{target_month}\'!R:R,">={data_ini_str}",\'{target_month}\'!R:R,"<={data_fim_str}")')
-    ws_resumo.cell(row=15, column=col_idx, value=f"={letra}13-{letra}14")
-    ws_resumo.cell(row=17, column=col_idx, value=f"={letra}14-{letra}10")
-    
+    valores = {9: header_str}
+    valores.update((row, formula.format(letra=letra, aba=mes.nome, data_ini=data_ini_str, data_fim=data_fim_str)) for row, formula in FORMULAS_RESUMO_CICLO)
+    # A linha 18 repete o valor da coluna à esquerda; sem valor lá, a célula atual fica como está
     celula_esq_18 = ws_resumo.cell(row=18, column=col_idx - 1)
-    ws_resumo.cell(row=18, column=col_idx, value=celula_esq_18.value if celula_esq_18.value else None)
+    if celula_esq_18.value: valores[18] = celula_esq_18.value
+    escrever_coluna(ws_resumo, col_idx, valores)
     
-    col_molde = col_idx - 1
-    while col_molde >= 1:
-        if ws_resumo.cell(row=10, column=col_molde).value is not None: break
-        col_molde -= 1
-        
-    if col_molde >= 1:
+    col_molde = encontrar_coluna_molde(ws_resumo, 10, col_idx)
+    if col_molde:
         for r in range(9, 19): copiar_estilo(ws_resumo.cell(row=r, column=col_molde), ws_resumo.cell(row=r, column=col_idx))
 
-def verificar_e_corrigir_headers_regras(ws):
+def mapear_celulas_mescladas(ws):
+    # (linha, coluna) -> faixa mesclada que a contém
+    indice = {}
+    for faixa in ws.merged_cells.ranges: indice.update(dict.fromkeys(faixa.cells, faixa))
+    return indice
+
+def desfazer_mesclagem(ws, indice, faixa):
+    ws.unmerge_cells(str(faixa))
+    logger.debug("Mesclagem %s desfeita na aba %s", faixa.coord, ws.title)
+    for chave in faixa.cells: indice.pop(chave, None)
+
+def verificar_e_corrigir_headers_regras(ws, indice_mesclas=None):
     col_regra = None
-    for col in range(1, ws.max_column + 1):
-        valor = ws.cell(row=9, column=col).value
+    for col, valor in enumerate(next(ws.iter_rows(min_row=9, max_row=9, values_only=True), ()), start=1):
         if valor and 'REGRA' in str(valor).upper() and 'PARCELAMENTO' in str(valor).upper():
             col_regra = col
             break
@@ -158,45 +250,37 @@ def verificar_e_corrigir_headers_regras(ws):
     if not col_regra: return
     
     headers = ['CICLO PARCELAS', 'Repasse DataPrev p/Paketa', 'Receita Wiipo']
+    if indice_mesclas is None: indice_mesclas = mapear_celulas_mescladas(ws)
     for i, header in enumerate(headers, start=1):
         col_atual = col_regra + i
-        coord = f"{get_column_letter(col_atual)}9"
-        
-        for merged_range in list(ws.merged_cells.ranges):
-            if coord in merged_range:
-                ws.unmerge_cells(str(merged_range))
-                if (9, col_atual) in ws._cells: del ws._cells[(9, col_atual)]
-                break
+        merged_range = indice_mesclas.get((9, col_atual))
+        if merged_range is not None:
+            desfazer_mesclagem(ws, indice_mesclas, merged_range)
+            ws._cells.pop((9, col_atual), None)
                 
         celula = ws.cell(row=9, column=col_atual)
         celula.value = header
         copiar_estilo(ws.cell(row=9, column=col_regra), celula)
 
-def atualizar_resumo_bloco_final(base_wb, target_month, col_idx):
+def atualizar_resumo_bloco_final(base_wb, mes, col_idx, indice_mesclas=None):
     ws = base_wb['RESUMO']
     letra = get_column_letter(col_idx)
-    valor_linha2 = ws.cell(row=2, column=col_idx).value or target_month.replace('.', '/').lower()
+    valor_linha2 = ws.cell(row=2, column=col_idx).value or mes.faturado
     linhas_alvo = [20, 21, 22, 23]
     
+    if indice_mesclas is None: indice_mesclas = mapear_celulas_mescladas(ws)
     for linha_num in linhas_alvo:
-        coord = f"{letra}{linha_num}"
-        for merged_range in list(ws.merged_cells.ranges):
-            if coord in merged_range:
-                ws.unmerge_cells(str(merged_range))
-                if (linha_num, col_idx) in ws._cells: del ws._cells[(linha_num, col_idx)]
-                break
+        merged_range = indice_mesclas.get((linha_num, col_idx))
+        if merged_range is not None:
+            desfazer_mesclagem(ws, indice_mesclas, merged_range)
+            ws._cells.pop((linha_num, col_idx), None)
                 
-    ws.cell(row=20, column=col_idx).value = valor_linha2
-    ws.cell(row=21, column=col_idx).value = f"={letra}6"
-    ws.cell(row=22, column=col_idx).value = f"={letra}12"
-    ws.cell(row=23, column=col_idx).value = f"=SUM({letra}21:{letra}22)"
+    valores = {20: valor_linha2}
+    valores.update((row, formula.format(letra=letra)) for row, formula in FORMULAS_RESUMO_BLOCO_FINAL)
+    escrever_coluna(ws, col_idx, valores)
     
-    col_anterior = col_idx - 1
-    while col_anterior >= 1:
-        if ws.cell(row=20, column=col_anterior).value is not None: break
-        col_anterior -= 1
-        
-    if col_anterior >= 1:
+    col_anterior = encontrar_coluna_molde(ws, 20, col_idx)
+    if col_anterior:
         letra_anterior = get_column_letter(col_anterior)
         ws.column_dimensions[letra].width = ws.column_dimensions[letra_anterior].width
         for r in linhas_alvo:
@@ -204,123 +288,170 @@ def atualizar_resumo_bloco_final(base_wb, target_month, col_idx):
                 try: copiar_estilo(ws.cell(row=r, column=col_anterior), ws.cell(row=r, column=col_idx))
                 except: pass
 
+def atualizar_resumo(base_wb, mes):
+    # Linha 2: última coluna preenchida e primeira coluna que já traz o mês faturado
+    ws_resumo = base_wb['RESUMO']
+    mes_faturado = mes.faturado
+    ultima_col, col_existente = 1, None
+    for col, val in enumerate(next(ws_resumo.iter_rows(min_row=2, max_row=2, max_col=ws_resumo.max_column, values_only=True), ()), start=1):
+        if val is None: continue
+        ultima_col = col
+        if col_existente is None and str(val).strip().lower() == mes_faturado: col_existente = col
+
+    coluna_alvo = atualizar_resumo_mes_faturamento(base_wb, mes, ultima_col)
+    atualizar_resumo_ciclo_pmt(base_wb, mes, col_existente or coluna_alvo)
+    # Um só índice de mesclagens para as duas etapas
+    indice_mesclas = mapear_celulas_mescladas(ws_resumo)
+    verificar_e_corrigir_headers_regras(ws_resumo, indice_mesclas)
+    atualizar_resumo_bloco_final(base_wb, mes, coluna_alvo, indice_mesclas)
+
 def copiar_producao_para_base(ws_origem, ws_destino):
-    last_row_base = 0
-    for row in range(1, ws_destino.max_row + 1):
-        if ws_destino.cell(row=row, column=1).value is not None: last_row_base = row
-    if last_row_base == 0: last_row_base = 1
-    
-    new_row = last_row_base + 1
-    linhas_copiadas = 0
+    last_row_base = encontrar_ultima_linha(ws_destino) or 1
     
-    for source_row in range(2, ws_origem.max_row + 1):
-        if ws_origem.cell(row=source_row, column=1).value is None: break
-        
-        for col in range(1, 8):
-            cell_nova = ws_destino.cell(row=new_row, column=col, value=ws_origem.cell(row=source_row, column=col).value)
-            if last_row_base > 1: copiar_estilo(ws_destino.cell(row=last_row_base, column=col), cell_nova)
-                
-        cell_nova = ws_destino.cell(row=new_row, column=8, value=f"=F{new_row}")
-        if last_row_base > 1: copiar_estilo(ws_destino.cell(row=last_row_base, column=8), cell_nova)
-            
-        for origem_col in range(8, 11):
-            destino_col = origem_col + 1
-            cell_nova = ws_destino.cell(row=new_row, column=destino_col, value=ws_origem.cell(row=source_row, column=origem_col).value)
-            if last_row_base > 1: copiar_estilo(ws_destino.cell(row=last_row_base, column=destino_col), cell_nova)
-                
-        new_row += 1
-        linhas_copiadas += 1
-    return linhas_copiadas
-
-def validar_template_jan26(workbook):
-    template_nome = 'JAN.26'
-    if template_nome in workbook.sheetnames: return True, f"Template '{template_nome}' encontrado"
-    return False, f"ERRO CRÍTICO: Aba '{template_nome}' não encontrada."
-
-def limpar_dados_worksheet(ws, manter_linha_1=True):
-    linha_inicial = 2 if manter_linha_1 else 1
-    for row_idx in range(ws.max_row, linha_inicial - 1, -1):
-        for col_idx in range(1, ws.max_column + 1): ws.cell(row=row_idx, column=col_idx).value = None
+    # Estilo de cada coluna de destino vem da última linha preenchida
+    celulas = ws_destino._cells
+    estilos = [None] * 11
+    if last_row_base > 1:
+        for col in range(1, 12):
+            molde = celulas.get((last_row_base, col))
+            if molde is not None and molde.has_style: estilos[col - 1] = molde._style
+
+    # append() continua a partir da última linha preenchida
+    fim_anterior = ws_destino._current_row
+    ws_destino._current_row = last_row_base
+
+    # Origem A–G, fórmula em H e origem H–J deslocada para I–K
+    linhas_origem = list(takewhile(lambda valores: valores[0] is not None, ws_origem.iter_rows(min_row=2, max_col=10, values_only=True)))
+    formulas = [f"=F{row}" for row in range(last_row_base + 1, last_row_base + len(linhas_origem) + 1)]
+    linhas_novas = [(*valores[:7], formula, *valores[7:]) for valores, formula in zip(linhas_origem, formulas)]
+
+    # Colunas sem molde mantêm a formatação que já existia na linha de destino
+    com_molde = [(col - 1, estilo) for col, estilo in enumerate(estilos, start=1) if estilo is not None]
+    sem_molde = [col for col, estilo in enumerate(estilos, start=1) if estilo is None]
+    for new_row, linha in enumerate(linhas_novas, start=last_row_base + 1):
+        nova_linha = [Cell(ws_destino, value=valor) for valor in linha]
+        for pos, estilo in com_molde: nova_linha[pos]._style = copy(estilo)
+        for col in sem_molde:
+            existente = celulas.get((new_row, col))
+            if existente is not None and existente.has_style: nova_linha[col - 1]._style = copy(existente._style)
+        ws_destino.append(nova_linha)
+
+    ws_destino._current_row = max(fim_anterior, ws_destino._current_row)
+    return len(linhas_novas)
+
+def criar_aba_a_partir_do_template(base_wb, ws_template, titulo):
+    # Copia cabeçalho, formatação e mesclagens da aba-modelo; das linhas de dados só o estilo
+    ws_nova = base_wb.create_sheet(titulo)
+    celulas = ws_nova._cells
+    for (row, col), celula in ws_template._cells.items():
+        if isinstance(celula, MergedCell) or (row > 1 and not celula.has_style): continue
+        nova = celulas[(row, col)] = Cell(ws_nova, row=row, column=col)
+        if row == 1: nova._value, nova.data_type = celula._value, celula.data_type
+        if celula.has_style: nova._style = copy(celula._style)
+    for atributo in ('row_dimensions', 'column_dimensions'):
+        origem, destino = getattr(ws_template, atributo), getattr(ws_nova, atributo)
+        for chave, dim in origem.items():
+            destino[chave] = copy(dim)
+            destino[chave].worksheet = ws_nova
+    ws_nova.merged_cells = copy(ws_template.merged_cells)
+    ws_nova.sheet_format = copy(ws_template.sheet_format)
+    ws_nova.sheet_properties = copy(ws_template.sheet_properties)
+    ws_nova.page_margins = copy(ws_template.page_margins)
+    ws_nova.page_setup = copy(ws_template.page_setup)
+    ws_nova.print_options = copy(ws_template.print_options)
+    return ws_nova
 
 def aplicar_regras_colunas_n_x(ws, target_month, linha_inicio=2):
     mes_faturado = target_month.replace('.', '-').lower()
-    ultima_linha = linha_inicio - 1
-    for row in range(linha_inicio, ws.max_row + 1):
-        if ws.cell(row=row, column=1).value is not None: ultima_linha = row
-        else: break
+    # Coluna A até o primeiro vazio
+    coluna_a = next(ws.iter_cols(min_col=1, max_col=1, min_row=linha_inicio, values_only=True), ())
+    ccbs_todos = list(takewhile(lambda ccb: ccb is not None, coluna_a))
+    ultima_linha = linha_inicio - 1 + len(ccbs_todos)
             
     if ultima_linha < linha_inicio: return {'linhas_n_o': 0, 'linhas_q_w': 0, 'ccbs_unicos': 0}
     
-    for row in range(linha_inicio, ultima_linha + 1):
-        ws.cell(row=row, column=14, value=mes_faturado)
-        ws.cell(row=row, column=15, value=f"=VLOOKUP(A{row},'BASE'!A:H,8,0)")
-        ws.cell(row=row, column=16, value=None)
-        
-    ccbs_todos = [ws.cell(row=row, column=1).value for row in range(linha_inicio, ultima_linha + 1) if ws.cell(row=row, column=1).value is not None]
-    ccbs_unicos = []
+    # N–P em toda linha; Q–X uma vez por CCB, na próxima linha livre do bloco
     vistos = set()
-    for ccb in ccbs_todos:
-        if ccb not in vistos:
-            ccbs_unicos.append(ccb)
-            vistos.add(ccb)
-            
     row_destino = linha_inicio
-    for ccb_unico in ccbs_unicos:
-        ws.cell(row=row_destino, column=17, value=ccb_unico)
-        ws.cell(row=row_destino, column=18, value=f"=VLOOKUP(Q{row_destino},'BASE'!A:K,11,0)")
-        ws.cell(row=row_destino, column=19, value=f"=SUMIF(A:A,Q{row_destino},L:L)")
-        ws.cell(row=row_destino, column=20, value=f"=VLOOKUP(Q{row_destino},'BASE'!A:H,8,0)")
-        for col in [21, 22, 23, 24]: ws.cell(row=row_destino, column=col, value=None)
+    for row, ccb in enumerate(ccbs_todos, start=linha_inicio):
+        escrever_linha(ws, row, {14: mes_faturado, 15: f"=VLOOKUP(A{row},'BASE'!A:H,8,0)", 16: None})
+        if ccb in vistos: continue
+        vistos.add(ccb)
+        escrever_linha(ws, row_destino, {
+            17: ccb,
+            18: f"=VLOOKUP(Q{row_destino},'BASE'!A:K,11,0)",
+            19: f"=SUMIF(A:A,Q{row_destino},L:L)",
+            20: f"=VLOOKUP(Q{row_destino},'BASE'!A:H,8,0)",
+            21: None, 22: None, 23: None, 24: None,
+        })
         row_destino += 1
-    return {'linhas_n_o': ultima_linha - linha_inicio + 1, 'linhas_q_w': len(ccbs_unicos), 'ccbs_unicos': len(ccbs_unicos)}
+    return {'linhas_n_o': ultima_linha - linha_inicio + 1, 'linhas_q_w': len(vistos), 'ccbs_unicos': len(vistos)}
 
 def encontrar_colunas_meses(ws_base):
     colunas_meses = []
     col_data_index = encontrar_coluna_por_header(ws_base, 'DATA') or (ws_base.max_column + 1)
-    for col_idx in range(17, col_data_index):
-        header = ws_base.cell(row=1, column=col_idx).value
+    if col_data_index <= 17: return colunas_meses
+    # Cabeçalhos de Q até a coluna antes de DATA
+    cabecalhos = next(ws_base.iter_rows(min_row=1, max_row=1, min_col=17, max_col=col_data_index - 1, values_only=True))
+    for col_idx, header in enumerate(cabecalhos, start=17):
         if header: colunas_meses.append({'nome': header, 'indice': col_idx, 'letra': get_column_letter(col_idx)})
     return colunas_meses
 
-def inserir_coluna_mes(ws_base, target_month, colunas_meses):
+def inserir_coluna_mes(ws_base, target_month, colunas_meses, ultima_linha=None):
     pos_insercao = colunas_meses[-1]['indice'] + 1 if colunas_meses else 17
     ws_base.insert_cols(pos_insercao)
     ws_base.cell(row=1, column=pos_insercao, value=target_month)
-    ultima_linha = encontrar_ultima_linha(ws_base)
-    for row in range(2, ultima_linha + 1): ws_base.cell(row=row, column=pos_insercao, value=f"=COUNTIF('{target_month}'!A:A,BASE!A{row})")
+    _CACHE_CABECALHOS.pop(ws_base, None)
+    if ultima_linha is None: ultima_linha = encontrar_ultima_linha(ws_base)
+    prefixo = f"=COUNTIF('{target_month}'!A:A,BASE!A"
+    escrever_coluna(ws_base, pos_insercao, {row: f"{prefixo}{row})" for row in range(2, ultima_linha + 1)})
     return {'nome': target_month, 'indice': pos_insercao, 'letra': get_column_letter(pos_insercao)}
 
-def aplicar_formulas_dinamicas(ws_base, colunas_meses, base_wb):
-    ultima_linha = ws_base.max_row
-    while ultima_linha > 1 and ws_base.cell(row=ultima_linha, column=1).value is None: ultima_linha -= 1
+# A2 como referência de célula inteira: não casa com AA2, A20 ou A21
+PADRAO_A2 = re.compile(r'(?<![A-Za-z])A2(?!\d)')
+
+def aplicar_formulas_dinamicas(ws_base, colunas_meses, base_wb, ultima_linha=None):
+    if ultima_linha is None: ultima_linha = encontrar_ultima_linha(ws_base)
     if ultima_linha < 2 or not colunas_meses: return 0
     target_month_sheet = colunas_meses[-1]['nome']
 
-    formula_l_limpa = str(ws_base.cell(row=2, column=12).value or "").replace(";", ",")
+    # Fórmulas-modelo de L, M e N na linha 2
+    molde_l, molde_m, molde_n = next(ws_base.iter_rows(min_row=2, max_row=2, min_col=12, max_col=14, values_only=True))
+    formula_l_limpa = str(molde_l or "").replace(";", ",")
     nova_formula_l = f'=IF(OR(NOT(ISERROR(VLOOKUP(A2,\'{target_month_sheet}\'!A:A,1,0)))),"Sim","Não")' if not formula_l_limpa.startswith("=") else formula_l_limpa.replace('),"Sim"', f",NOT(ISERROR(VLOOKUP(A2,'{target_month_sheet}'!A:A,1,0)))" + '),"Sim"') if target_month_sheet not in formula_l_limpa else formula_l_limpa
 
-    formula_m_limpa = str(ws_base.cell(row=2, column=13).value or "").replace(";", ",")
+    formula_m_limpa = str(molde_m or "").replace(";", ",")
     nova_formula_m = '="Pendente de pagamento"' if not formula_m_limpa.startswith("=") else formula_m_limpa.replace('"Pendente de pagamento"', f"IFERROR(VLOOKUP(A2,'{target_month_sheet}'!A:N,14,0), " + '"Pendente de pagamento"') + ")" if target_month_sheet not in formula_m_limpa else formula_m_limpa
 
-    formula_n_limpa = str(ws_base.cell(row=2, column=14).value or "").replace(";", ",")
+    formula_n_limpa = str(molde_n or "").replace(";", ",")
     nova_formula_n = f"=COUNTIF('{target_month_sheet}'!A:A,BASE!A2)" if not formula_n_limpa.startswith("=") else formula_n_limpa + f"+COUNTIF('{target_month_sheet}'!A:A,BASE!A2)" if target_month_sheet not in formula_n_limpa else formula_n_limpa
 
-    linhas_processadas = 0
-    for row in range(2, ultima_linha + 1):
-        ws_base.cell(row=row, column=12, value=nova_formula_l.replace("A2", f"A{row}"))
-        ws_base.cell(row=row, column=13, value=nova_formula_m.replace("A2", f"A{row}"))
-        ws_base.cell(row=row, column=14, value=nova_formula_n.replace("A2", f"A{row}"))
-        if row > 2:
-            try:
-                for col in [12, 13, 14]: copiar_estilo(ws_base.cell(row-1, col), ws_base.cell(row, col))
-            except: pass
-        linhas_processadas += 1
-    return linhas_processadas
+    # Moldes quebrados nas referências a A2; cada linha junta os pedaços com a própria
+    partes_l, partes_m, partes_n = PADRAO_A2.split(nova_formula_l), PADRAO_A2.split(nova_formula_m), PADRAO_A2.split(nova_formula_n)
+    # Da linha 3 em diante L, M e N repetem a formatação da linha 2
+    celulas, estilos = ws_base._cells, estilos_da_linha(ws_base, 2, (12, 13, 14))
+    linhas = range(2, ultima_linha + 1)
+    for col, partes in ((12, partes_l), (13, partes_m), (14, partes_n)):
+        escrever_coluna(ws_base, col, {row: f"A{row}".join(partes) for row in linhas})
+    for row in linhas[1:]:
+        for col, estilo in estilos.items(): celulas[(row, col)]._style = copy(estilo)
+    return len(linhas)
+
+# Referência à coluna A (relativa ou absoluta) nas fórmulas-modelo de L e M
+PADRAO_REF_COLUNA_A = re.compile(r'\$?[Aa]\$?\d+')
+
+def extrair_numeros(serie):
+    # Números passam direto, textos '1.234,56' são convertidos e o resto vira 0.0
+    eh_numero = serie.map(lambda valor: isinstance(valor, (int, float))).astype(bool)
+    texto = serie.astype(str).str.strip().str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
+    convertidos = pd.to_numeric(texto.where(~eh_numero), errors='coerce')
+    return pd.to_numeric(serie.where(eh_numero), errors='coerce').where(eh_numero, convertidos).fillna(0.0).astype(float)
 
 def processar_inadimplentes(dados_filtrados, ws_destino, base_wb, nome_coluna_id):
-    def limpar_id(valor): return "" if pd.isna(valor) else str(valor).strip().replace('.0', '')
-    valores_coluna_q = {limpar_id(c.value) for c in ws_destino['Q'] if c.value is not None}
-    ids_novos = dados_filtrados[nome_coluna_id].dropna().apply(limpar_id)
+    # IDs limpos na coluna inteira; vazio vira ""
+    def limpar_ids(serie): return serie.astype(str).str.strip().str.replace('.0', '', regex=False).where(serie.notna(), "")
+    valores_coluna_q = set(limpar_ids(pd.Series([c.value for c in ws_destino['Q'] if c.value is not None], dtype=object)))
+    ids_novos = limpar_ids(dados_filtrados[nome_coluna_id].dropna())
     ids_inadimplentes = [id_val for id_val in ids_novos.unique() if id_val and id_val not in valores_coluna_q]
     
     if ids_inadimplentes:
@@ -328,31 +459,34 @@ def processar_inadimplentes(dados_filtrados, ws_destino, base_wb, nome_coluna_id
         ws_inad, ws_base = base_wb['INADIMPLENTES'], base_wb['BASE']
         linha_destino = ws_inad.max_row + 1
         formula_molde_L, formula_molde_M = str(ws_base.cell(row=2, column=12).value or ""), str(ws_base.cell(row=2, column=13).value or "")
+        # Moldes quebrados nas referências à coluna A; cada linha junta os pedaços
+        partes_L, partes_M = PADRAO_REF_COLUNA_A.split(formula_molde_L), PADRAO_REF_COLUNA_A.split(formula_molde_M)
 
         df_temp = dados_filtrados.copy()
-        df_temp['ID_LIMPO'] = df_temp[nome_coluna_id].apply(limpar_id)
+        df_temp['ID_LIMPO'] = limpar_ids(df_temp[nome_coluna_id])
         df_inadimplentes = df_temp[df_temp['ID_LIMPO'].isin(ids_inadimplentes)].drop_duplicates(subset=['ID_LIMPO'])
 
-        def extrair_numero(val):
-            if pd.isna(val) or str(val).strip().startswith('='): return 0.0
-            if isinstance(val, (int, float)): return float(val)
-            try: return float(str(val).replace('.', '').replace(',', '.'))
-            except: return 0.0
-            
-        for _, row in df_inadimplentes.iterrows():
+        # D, E, I e N convertidos e J, O e P recalculados na coluna inteira
+        valor_emp, parcelas, fee, recebidas = (extrair_numeros(df_inadimplentes.iloc[:, col]) for col in (3, 4, 8, 13))
+        calculados = zip(
+            (valor_emp * fee).tolist(),
+            (recebidas / parcelas.where(parcelas > 0)).fillna(0.0).tolist(),
+            (parcelas - recebidas).clip(lower=0).tolist(),
+        )
+
+        linha_inicial = linha_destino
+        linhas_novas = []
+        for (_, row), (val_j, val_o, val_p) in zip(df_inadimplentes.iterrows(), calculados):
             valores_linha = row.iloc[0:16].tolist()
-            val_valor_emp, val_parcelas, val_fee, val_recebidas = extrair_numero(valores_linha[3]), extrair_numero(valores_linha[4]), extrair_numero(valores_linha[8]), extrair_numero(valores_linha[13])
             
             valores_linha[7] = valores_linha[5]
-            valores_linha[9] = val_valor_emp * val_fee
-            valores_linha[14] = (val_recebidas / val_parcelas) if val_parcelas > 0 else 0.0
-            valores_linha[15] = max(0, val_parcelas - val_recebidas)
+            valores_linha[9], valores_linha[14], valores_linha[15] = val_j, val_o, val_p
 
+            valores_excel = []
             for col_idx, valor in enumerate(valores_linha, start=1):
-                texto_valor = str(valor).strip()
-                if col_idx == 12 and formula_molde_L.startswith('='): valor_excel = re.sub(r'\$?[Aa]\$?\d+', f'A{linha_destino}', formula_molde_L)
-                elif col_idx == 13 and formula_molde_M.startswith('='): valor_excel = re.sub(r'\$?[Aa]\$?\d+', f'A{linha_destino}', formula_molde_M)
-                elif pd.isna(valor) or texto_valor.startswith('='): valor_excel = None
+                if col_idx == 12 and formula_molde_L.startswith('='): valor_excel = f'A{linha_destino}'.join(partes_L)
+                elif col_idx == 13 and formula_molde_M.startswith('='): valor_excel = f'A{linha_destino}'.join(partes_M)
+                elif pd.isna(valor) or (isinstance(valor, str) and valor.lstrip().startswith('=')): valor_excel = None
                 elif col_idx == 8:
                     if isinstance(valor, str) and 'T' in valor:
                         try: valor_excel = pd.to_datetime(valor.split('T')[0]).date()
@@ -361,78 +495,208 @@ def processar_inadimplentes(dados_filtrados, ws_destino, base_wb, nome_coluna_id
                     else: valor_excel = valor
                 elif isinstance(valor, pd.Timestamp): valor_excel = valor.to_pydatetime()
                 else: valor_excel = valor
-
-                celula_nova = ws_inad.cell(row=linha_destino, column=col_idx, value=valor_excel)
-                if linha_destino > 2:
-                    try: copiar_estilo(ws_inad.cell(row=linha_destino - 1, column=col_idx), celula_nova)
-                    except: pass 
-                    
-                if col_idx == 6: celula_nova.number_format = 'yyyy-mm-ddThh:mm:ss'
-                elif col_idx in [8, 13]: celula_nova.number_format = 'dd/mm/yyyy'
-                elif col_idx in [4, 10]: celula_nova.number_format = '#,##0.00'
-                elif col_idx in [9, 15]: celula_nova.number_format = '0.00%'
+                valores_excel.append(valor_excel)
+            linhas_novas.append(tuple(valores_excel))
             linha_destino += 1
-    if 'INADIMPLENTES' in base_wb.sheetnames: base_wb['INADIMPLENTES'].auto_filter.ref = base_wb['INADIMPLENTES'].dimensions
+
+        # Estilo de cada coluna, tirado da última linha existente
+        estilos = []
+        for col_idx in range(1, 17):
+            prototipo = Cell(ws_inad)
+            if linha_inicial > 2:
+                try: copiar_estilo(ws_inad.cell(row=linha_inicial - 1, column=col_idx), prototipo)
+                except: pass
+            if col_idx == 6: prototipo.number_format = 'yyyy-mm-ddThh:mm:ss'
+            elif col_idx in [8, 13]: prototipo.number_format = 'dd/mm/yyyy'
+            elif col_idx in [4, 10]: prototipo.number_format = '#,##0.00'
+            elif col_idx in [9, 15]: prototipo.number_format = '0.00%'
+            estilos.append(prototipo._style if prototipo.has_style else None)
+
+        # append() continua a partir da primeira linha livre
+        ws_inad._current_row = linha_inicial - 1
+        for valores in linhas_novas:
+            celulas = [Cell(ws_inad, value=valor) for valor in valores]
+            for celula, estilo in zip(celulas, estilos):
+                if estilo is not None: celula._style = copy(estilo)
+            ws_inad.append(celulas)
+    if 'INADIMPLENTES' in base_wb.sheetnames:
+        ws_inad = base_wb['INADIMPLENTES']
+        ws_inad.auto_filter.ref = ws_inad.dimensions
     return base_wb
 
+def converter_datas(serie):
+    # Só os textos passam por format='mixed'
+    texto = serie.map(lambda valor: isinstance(valor, str)).astype(bool)
+    datas = pd.to_datetime(serie.mask(texto), errors='coerce')
+    if texto.any(): datas[texto] = pd.to_datetime(serie[texto], errors='coerce', format='mixed')
+    return datas.dt.date
+
+# Posição (base 0) da coluna de data do ciclo no DataFrame da aba do mês
+IDX_COLUNA_DATA_CICLO = column_index_from_string('F') - 1
+
 def processar_ciclo_validacao(base_df, base_wb, target_month_name, data_inicio, data_fim):
-    COLUNA_DATA_LETRA = 'F' 
     ws_destino = base_wb[target_month_name]
-    idx_data = column_index_from_string(COLUNA_DATA_LETRA) - 1
-    nome_coluna_data = base_df.columns[idx_data]
+    nome_coluna_data = base_df.columns[IDX_COLUNA_DATA_CICLO]
     nome_coluna_id = base_df.columns[0]
     
-    coluna_datas_limpas = pd.to_datetime(base_df[nome_coluna_data], errors='coerce', format='mixed').dt.date
+    coluna_datas_limpas = converter_datas(base_df[nome_coluna_data])
     mask = (coluna_datas_limpas >= data_inicio) & (coluna_datas_limpas <= data_fim)
     dados_filtrados = base_df[mask].copy()
     qtd = len(dados_filtrados)
     
-    max_row = ws_destino.max_row
-    if max_row >= 2:
-        for row in ws_destino.iter_rows(min_row=2, max_row=max_row, min_col=22, max_col=24):
-            for cell in row: cell.value = None
+    # Limpa V, W e X nas células existentes; sem formatação, a célula sai de _cells
+    celulas = ws_destino._cells
+    for row in range(2, ws_destino.max_row + 1):
+        for col in (22, 23, 24):
+            celula = celulas.get((row, col))
+            if celula is None: continue
+            if celula.has_style: celula.value = None
+            else: del celulas[(row, col)]
             
-    linha_atual = 2
-    for index, row in dados_filtrados.iterrows():
-        ws_destino.cell(row=linha_atual, column=22).value = row[nome_coluna_id]
-        ws_destino.cell(row=linha_atual, column=23).value = coluna_datas_limpas[index]
-        ws_destino.cell(row=linha_atual, column=24).value = f'=IF(ISNUMBER(MATCH(V{linha_atual},Q:Q,0)),"Sim","Não")'
-        if linha_atual > 2:
-             try:
-                 for col in [22, 23, 24]: copiar_estilo(ws_destino.cell(linha_atual-1, col), ws_destino.cell(linha_atual, col))
-             except: pass
-        linha_atual += 1
+    # V, W e X gravadas coluna a coluna
+    linhas = range(2, qtd + 2)
+    escrever_coluna(ws_destino, 22, dict(zip(linhas, dados_filtrados[nome_coluna_id].tolist())))
+    escrever_coluna(ws_destino, 23, dict(zip(linhas, coluna_datas_limpas[mask].tolist())))
+    escrever_coluna(ws_destino, 24, {row: f'=IF(ISNUMBER(MATCH(V{row},Q:Q,0)),"Sim","Não")' for row in linhas})
+    estilos = estilos_da_linha(ws_destino, 2, (22, 23, 24))
+    for row in linhas[1:]:
+        for col, estilo in estilos.items(): ws_destino.cell(row=row, column=col)._style = copy(estilo)
     processar_inadimplentes(dados_filtrados, ws_destino, base_wb, nome_coluna_id)
     return qtd
 
-def aplicar_formulas_estaticas(ws_base, linha_inicio):
-    ultima_linha = encontrar_ultima_linha(ws_base)
+def aplicar_formulas_estaticas(ws_base, linha_inicio, ultima_linha=None):
+    if ultima_linha is None: ultima_linha = encontrar_ultima_linha(ws_base)
     col_data_index = encontrar_coluna_por_header(ws_base, 'DATA')
-    linhas_processadas = 0
-    for row in range(linha_inicio, ultima_linha + 1):
-        linha_molde = row - 1
-        for col, formula in [(15, f"=N{row}/E{row}"), (16, f"=E{row}-N{row}"), (col_data_index, f'=TEXT(F{row},"dd/mm/aaaa")')]:
-            cell = ws_base.cell(row=row, column=col, value=formula)
-            if linha_molde >= 2: copiar_estilo(ws_base.cell(row=linha_molde, column=col), cell)
-        linhas_processadas += 1
-    return linhas_processadas
+    if col_data_index is None: raise ValueError(f"Coluna 'DATA' não encontrada na aba {ws_base.title}")
+    # Linhas novas repetem a formatação da última linha antiga (nunca acima da linha 2)
+    linha_molde = max(linha_inicio - 1, 2)
+    celulas, estilos = ws_base._cells, estilos_da_linha(ws_base, linha_molde, (15, 16, col_data_index))
+    linhas = range(linha_inicio, ultima_linha + 1)
+    escrever_coluna(ws_base, 15, {row: f"=N{row}/E{row}" for row in linhas})
+    escrever_coluna(ws_base, 16, {row: f"=E{row}-N{row}" for row in linhas})
+    escrever_coluna(ws_base, col_data_index, {row: f'=TEXT(F{row},"dd/mm/aaaa")' for row in linhas})
+    for row in range(max(linha_inicio, linha_molde + 1), ultima_linha + 1):
+        for col, estilo in estilos.items(): celulas[(row, col)]._style = copy(estilo)
+    return len(linhas)
 
 def atualizar_aba_base(base_wb, parceiro_wb, target_month, linha_inicio_append):
     ws_base, ws_producao = base_wb['BASE'], parceiro_wb['Produção']
     colunas_meses = encontrar_colunas_meses(ws_base)
-    col_inserida = inserir_coluna_mes(ws_base, target_month, colunas_meses)
+    # Uma varredura da última linha serve às três etapas
+    ultima_linha = encontrar_ultima_linha(ws_base)
+    col_inserida = inserir_coluna_mes(ws_base, target_month, colunas_meses, ultima_linha)
     colunas_meses.append(col_inserida)
-    aplicar_formulas_dinamicas(ws_base, colunas_meses, base_wb)
-    aplicar_formulas_estaticas(ws_base, linha_inicio_append)
+    aplicar_formulas_dinamicas(ws_base, colunas_meses, base_wb, ultima_linha)
+    aplicar_formulas_estaticas(ws_base, linha_inicio_append, ultima_linha)
 
 def inserir_dados_colunas_especificas(ws_origem, ws_destino, col_inicio=1, col_fim=13, linha_destino_inicio=2):
+    # Grava nas células herdadas da aba-modelo, mantendo a formatação delas
     linha_destino = linha_destino_inicio
     for row in ws_origem.iter_rows(min_row=2, values_only=True):
-        if all(cell is None for cell in row): continue
-        for col_idx in range(col_inicio, min(col_fim + 1, len(row) + 1)):
-            ws_destino.cell(row=linha_destino, column=col_idx, value=row[col_idx - 1] if col_idx <= len(row) else None)
+        # Pula linhas vazias
+        if row.count(None) == len(row): continue
+        escrever_linha(ws_destino, linha_destino, dict(enumerate(row[col_inicio - 1:col_fim], start=col_inicio)))
         linha_destino += 1
 
+def assinar_entradas(arquivo_parceiro, arquivo_base, target_month, data_inicio, data_fim):
+    # O hash do PARCEIRO também é a chave do cache
+    hash_parceiro = hashlib.blake2b(arquivo_parceiro.getbuffer(), digest_size=16).hexdigest()
+    hash_base = hashlib.blake2b(arquivo_base.getbuffer(), digest_size=16).hexdigest()
+    parametros = f"{hash_parceiro}|{hash_base}|{target_month}|{data_inicio}|{data_fim}"
+    return hash_parceiro, hashlib.blake2b(parametros.encode(), digest_size=16).hexdigest()
+
+# Pausas do GC contadas sob trava; o coletor volta quando a última termina
+_GC_TRAVA = threading.Lock()
+_GC_PAUSAS = {'ativas': 0, 'reativar': False}
+
+@contextmanager
+def gc_pausado():
+    with _GC_TRAVA:
+        if _GC_PAUSAS['ativas'] == 0:
+            _GC_PAUSAS['reativar'] = gc.isenabled()
+            gc.disable()
+        _GC_PAUSAS['ativas'] += 1
+    try:
+        yield
+    finally:
+        with _GC_TRAVA:
+            _GC_PAUSAS['ativas'] -= 1
+            if _GC_PAUSAS['ativas'] == 0 and _GC_PAUSAS['reativar']: gc.enable()
+
+def carregar_base(arquivo_base):
+    arquivo_base.seek(0)
+    with gc_pausado(): return openpyxl.load_workbook(arquivo_base, data_only=False, keep_vba=False)
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def carregar_parceiro(hash_arquivo, _arquivo):
+    # Cache pelo hash do conteúdo (parâmetros com "_" não entram na chave)
+    # Somente-leitura sobre uma cópia dos bytes, ignorando a <dimension> gravada no arquivo
+    parceiro_wb = openpyxl.load_workbook(BytesIO(_arquivo.getvalue()), read_only=True, data_only=True, keep_links=False)
+    for ws in parceiro_wb.worksheets: ws.reset_dimensions()
+    return parceiro_wb
+
+def processar_planilhas(arquivo_parceiro, arquivo_base, hash_parceiro, target_month, dt_inicio, dt_fim, registrar_etapa):
+    # Roda no pool: fala com a interface só pelo callback de etapas e pelo retorno
+    registrar_etapa("📥 Lendo planilhas pesadas para a memória (16GB RAM ativado)...")
+    # A BASE carrega numa thread enquanto o PARCEIRO é lido e validado aqui
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        futuro_base = executor.submit(carregar_base, arquivo_base)
+        parceiro_wb = carregar_parceiro(hash_parceiro, arquivo_parceiro)
+        registrar_etapa("⚙️ Executando validações iniciais...")
+        valido, mensagem = validar_abas_necessarias(parceiro_wb, ABAS_PARCEIRO_NECESSARIAS, 'PARCEIRO')
+        if not valido:
+            futuro_base.cancel()
+            raise ValueError(mensagem)
+        base_wb = futuro_base.result()
+
+    valido, mensagem = validar_abas_necessarias(base_wb, ABAS_BASE_NECESSARIAS, 'BASE')
+    if not valido: raise ValueError(mensagem)
+    ultima_linha_base = encontrar_ultima_linha(base_wb['BASE'])
+
+    registrar_etapa("🔄 Manipulando abas e copiando dados...")
+    # Abas resolvidas uma vez
+    abas = {ws.title: ws for ws in base_wb.worksheets}
+    if target_month in abas: base_wb.remove(abas.pop(target_month))
+    ws_mes = abas[target_month] = criar_aba_a_partir_do_template(base_wb, abas['JAN.26'], target_month)
+    inserir_dados_colunas_especificas(parceiro_wb['Parcelas Pagas'], ws_mes, 1, 13, 2)
+    aplicar_regras_colunas_n_x(ws_mes, target_month, 2)
+
+    linha_inicio_append = ultima_linha_base + 1
+
+    ws_base = abas['BASE']
+    copiar_producao_para_base(parceiro_wb['Produção'], ws_base)
+    atualizar_aba_base(base_wb, parceiro_wb, target_month, linha_inicio_append)
+
+    registrar_etapa("🧮 Processando Pandas DataFrame e Inadimplentes...")
+    # Colunas A–P da BASE lidas de _cells; a primeira linha vira o cabeçalho
+    celulas, colunas = ws_base._cells, range(1, min(16, ws_base.max_column) + 1)
+    linhas_base = (tuple(getattr(celulas.get((row, col)), 'value', None) for col in colunas) for row in range(1, ws_base.max_row + 1))
+    cols = next(linhas_base, None)
+    base_df_atualizado = pd.DataFrame.from_records(linhas_base, columns=cols) if cols is not None else pd.DataFrame()
+
+    processar_ciclo_validacao(base_df_atualizado, base_wb, target_month, dt_inicio, dt_fim)
+
+    if 'RESUMO' in abas:
+        registrar_etapa("📝 Atualizando aba de RESUMO...")
+        atualizar_resumo(base_wb, interpretar_mes(target_month))
+
+    registrar_etapa("💾 Gerando arquivo final Excel...")
+    # Arquivo temporário em memória até 8MB, em disco acima disso
+    arquivo_saida = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    with gc_pausado(): base_wb.save(arquivo_saida)
+
+    # Esvazia a RAM do servidor
+    del parceiro_wb
+    del base_wb
+    del base_df_atualizado
+    gc.collect()
+    return arquivo_saida
+
+@st.cache_resource(show_spinner=False)
+def obter_executor():
+    # Um único pool para todas as sessões, preservado entre reruns
+    return ThreadPoolExecutor(max_workers=2)
+
 # =========================================================
 # 2. INTERFACE DO STREAMLIT
 # =========================================================
@@ -459,75 +723,59 @@ with st.form("form_processamento"):
 if submit:
     if not arquivo_parceiro or not arquivo_base:
         st.error("⚠️ Por favor, envie as duas planilhas antes de processar.")
+    elif 'processamento' in st.session_state:
+        st.warning("⏳ Já existe um processamento em andamento. Aguarde a conclusão.")
     else:
-        with st.status("🚀 Processando planilhas com força total...", expanded=True) as status:
-            try:
-                st.write("📥 Lendo planilhas pesadas para a memória (16GB RAM ativado)...")
-                # Lê direto dos arquivos em memória
-                parceiro_wb = openpyxl.load_workbook(arquivo_parceiro, data_only=True)
-                base_wb = openpyxl.load_workbook(arquivo_base, data_only=False)
-                
-                st.write("⚙️ Executando validações iniciais...")
-                valido, mensagem = validar_abas_necessarias(parceiro_wb, base_wb)
-                if not valido: raise ValueError(mensagem)
-                    
-                template_existe, msg_template = validar_template_jan26(base_wb)
-                if not template_existe: raise ValueError(msg_template)
-
-                st.write("🔄 Manipulando abas e copiando dados...")
-                if target_month in base_wb.sheetnames: del base_wb[target_month]
-                ws_mes = base_wb.copy_worksheet(base_wb['JAN.26'])
-                ws_mes.title = target_month
-
-                limpar_dados_worksheet(ws_mes, manter_linha_1=True)
-                inserir_dados_colunas_especificas(parceiro_wb['Parcelas Pagas'], ws_mes, 1, 13, 2)
-                aplicar_regras_colunas_n_x(ws_mes, target_month, 2)
-
-                ultima_linha_base = encontrar_ultima_linha(base_wb['BASE'])
-                linha_inicio_append = ultima_linha_base + 1
-                
-                copiar_producao_para_base(parceiro_wb['Produção'], base_wb['BASE'])
-                atualizar_aba_base(base_wb, parceiro_wb, target_month, linha_inicio_append)
-
-                st.write("🧮 Processando Pandas DataFrame e Inadimplentes...")
-                ws_base_ativa = base_wb['BASE']
-                data = list(ws_base_ativa.values)
-                if data:
-                    cols = data[0]
-                    base_df_atualizado = pd.DataFrame(data[1:], columns=cols)
-                else:
-                    base_df_atualizado = pd.DataFrame()
-
-                processar_ciclo_validacao(base_df_atualizado, base_wb, target_month, dt_inicio, dt_fim)
-
-                if 'RESUMO' in base_wb.sheetnames:
-                    st.write("📝 Atualizando aba de RESUMO...")
-                    coluna_alvo = atualizar_resumo_mes_faturamento(base_wb, target_month)
-                    atualizar_resumo_ciclo_pmt(base_wb, target_month)
-                    verificar_e_corrigir_headers_regras(base_wb['RESUMO'])
-                    atualizar_resumo_bloco_final(base_wb, target_month, col_idx=coluna_alvo)
-
-                st.write("💾 Gerando arquivo final Excel...")
-                output = BytesIO()
-                base_wb.save(output)
-                output.seek(0)
-                
-                # Esvazia a RAM do servidor
-                del parceiro_wb
-                del base_wb
-                del base_df_atualizado
-                gc.collect()
-                
-                status.update(label="✅ Processamento Concluído com Sucesso!", state="complete", expanded=False)
-                
-                st.download_button(
-                    label="📥 Baixar Excel Processado",
-                    data=output,
-                    file_name=f"Processado_{target_month}.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                    type="primary"
-                )
-                
-            except Exception as e:
-                status.update(label="❌ Erro no Processamento", state="error")
-                st.error(f"Erro detalhado: {str(e)}")
\ No newline at end of file
+        hash_parceiro, assinatura_entradas = assinar_entradas(arquivo_parceiro, arquivo_base, target_month, dt_inicio, dt_fim)
+        if assinatura_entradas == st.session_state.get('ultima_assinatura') and 'base_xlsx_arquivo' in st.session_state:
+            # Mesmos arquivos e mesmos parâmetros: o resultado já gerado continua válido
+            st.info("♻️ Nada mudou desde o último processamento. O arquivo gerado continua disponível abaixo.")
+        else:
+            arquivo_anterior = st.session_state.pop('base_xlsx_arquivo', None)
+            if arquivo_anterior is not None: arquivo_anterior.close()
+            st.session_state.pop('ultima_assinatura', None)
+            # A sessão guarda o futuro e a lista de etapas que ele alimenta
+            log_etapas = []
+            st.session_state['processamento'] = {
+                'futuro': obter_executor().submit(processar_planilhas, arquivo_parceiro, arquivo_base, hash_parceiro, target_month, dt_inicio, dt_fim, log_etapas.append),
+                'etapas': log_etapas,
+                'assinatura': assinatura_entradas,
+                'nome_arquivo_saida': f"Processado_{target_month}.xlsx",
+            }
+
+if 'processamento' in st.session_state:
+    processamento = st.session_state['processamento']
+    futuro = processamento['futuro']
+    if not futuro.done():
+        with st.status("🚀 Processando planilhas com força total...", expanded=True):
+            st.markdown("  \n".join(processamento['etapas']))
+        # Reexecuta o script só para atualizar o progresso; o processamento segue no pool
+        time.sleep(0.5)
+        st.rerun()
+
+    del st.session_state['processamento']
+    with st.status("🚀 Processando planilhas com força total...", expanded=True) as status:
+        st.markdown("  \n".join(processamento['etapas']))
+        try:
+            st.session_state['base_xlsx_arquivo'] = futuro.result()
+            st.session_state['nome_arquivo_saida'] = processamento['nome_arquivo_saida']
+            st.session_state['ultima_assinatura'] = processamento['assinatura']
+            status.update(label="✅ Processamento Concluído com Sucesso!", state="complete", expanded=False)
+        except Exception as e:
+            status.update(label="❌ Erro no Processamento", state="error")
+            st.error(f"Erro detalhado: {str(e)}")
+
+if 'base_xlsx_arquivo' in st.session_state:
+    arquivo_saida = st.session_state['base_xlsx_arquivo']
+    def ler_arquivo_saida():
+        # Só roda no clique: os reruns não carregam o arquivo gerado na memória
+        arquivo_saida.seek(0)
+        return arquivo_saida.read()
+
+    st.download_button(
+        label="📥 Baixar Excel Processado",
+        data=ler_arquivo_saida,
+        file_name=st.session_state['nome_arquivo_saida'],
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        type="primary"
+    )
\ No newline at end of file
@@ -0,0 +1,81 @@
+import gc
+import re
+import sys
+import zipfile
+from io import BytesIO
+from pathlib import Path
+
+import openpyxl
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import app
+
+
+def test_template_com_linha_de_dados_mesclada():
+    base_wb = openpyxl.Workbook()
+    ws_template = base_wb.active
+    ws_template.title = 'JAN.26'
+    ws_template.append(['CCB', 'NOME', 'VALOR'])
+    ws_template.merge_cells('A4:C4')
+
+    parceiro_wb = openpyxl.Workbook()
+    ws_origem = parceiro_wb.active
+    ws_origem.append(['CCB', 'NOME', 'VALOR'])
+    for i in range(1, 5): ws_origem.append([i, f'cliente {i}', i * 10])
+
+    ws_mes = app.criar_aba_a_partir_do_template(base_wb, ws_template, 'FEV.26')
+    app.inserir_dados_colunas_especificas(ws_origem, ws_mes, 1, 3, 2)
+
+    assert [c.value for c in ws_mes[4]] == [3, 'cliente 3', 30]
+    assert [str(faixa) for faixa in ws_mes.merged_cells.ranges] == ['A4:C4']
+    assert [str(faixa) for faixa in ws_template.merged_cells.ranges] == ['A4:C4']
+
+
+def test_parceiro_com_dimension_desatualizada():
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = 'Produção'
+    for i in range(1, 11): ws.append([i, f'cliente {i}'])
+    arquivo = BytesIO()
+    wb.save(arquivo)
+
+    # Mesma planilha, mas com a <dimension> declarando só as três primeiras linhas
+    corrigido = BytesIO()
+    with zipfile.ZipFile(BytesIO(arquivo.getvalue())) as origem, zipfile.ZipFile(corrigido, 'w') as destino:
+        for item in origem.infolist():
+            dados = origem.read(item.filename)
+            if item.filename == 'xl/worksheets/sheet1.xml': dados = re.sub(rb'<dimension ref="[^"]*"', b'<dimension ref="A1:B3"', dados)
+            destino.writestr(item, dados)
+
+    parceiro_wb = app.carregar_parceiro('dimension-desatualizada', corrigido)
+    linhas = list(parceiro_wb['Produção'].iter_rows(values_only=True))
+    assert len(linhas) == 10
+    assert linhas[-1] == (10, 'cliente 10')
+
+
+def test_parceiro_sem_aba_necessaria_falha_e_religa_o_gc():
+    def salvar(wb):
+        arquivo = BytesIO()
+        wb.save(arquivo)
+        return arquivo
+
+    base_wb = openpyxl.Workbook()
+    base_wb.active.title = 'BASE'
+    for aba in ('INADIMPLENTES', 'JAN.26'): base_wb.create_sheet(aba)
+    parceiro_wb = openpyxl.Workbook()
+    parceiro_wb.active.title = 'Parcelas Pagas'
+
+    with pytest.raises(ValueError, match="Aba 'Produção' não encontrada no arquivo PARCEIRO"):
+        app.processar_planilhas(salvar(parceiro_wb), salvar(base_wb), 'sem-producao', 'FEV.26', None, None, lambda etapa: None)
+    assert gc.isenabled()
+
+
+def test_formulas_estaticas_sem_coluna_data():
+    ws_base = openpyxl.Workbook().active
+    ws_base.title = 'BASE'
+    ws_base.append(['CCB', 'NOME'])
+    ws_base.append([1, 'cliente 1'])
+
+    with pytest.raises(ValueError, match="Coluna 'DATA' não encontrada na aba BASE"):
+        app.aplicar_formulas_estaticas(ws_base, 2)